@@ -1,25 +1,32 @@
 import os
+import re
+import sys
+import time
+from typing import Any, Callable, Iterator
 
 import streamlit as st
 from dotenv import load_dotenv
 
 load_dotenv()
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 from langchain_community.utilities import SQLDatabase
 from langchain_core.messages import AIMessage, HumanMessage
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain_groq import ChatGroq
 from langchain_openai import ChatOpenAI
+from sqlalchemy import text
+from sqlalchemy.engine import Row
+from sqlalchemy.sql.expression import TextClause
 
+# Number of most recent chat messages sent to the model with each question
+RECENT_K = 6
 
-def init_database(user: str, password: str, host: str, port: str, database: str) -> SQLDatabase:
-    db_uri = f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{database}"
-    return SQLDatabase.from_uri(db_uri)
-
-
-def get_sql_chain(db):
-    template = """
+# Static instructions and schema come first so the prompt prefix is
+# byte-identical across turns; history and the question are appended after it.
+sql_system_template = """
     You are an AI data analyst who manages a Home Inventory. You are interacting with a user who is asking you questions about the Home Inventory's database.
     Based on the table schema below, write a SQL query that would answer the user's question. Take the conversation history into account.
 
@@ -29,48 +36,20 @@ def get_sql_chain(db):
     Also, generate a food recipe from the food items present in Inventory only when asked 'generate recipe' and do not display food recipe for any other query.
     <SCHEMA>{schema}</SCHEMA>
     
-    Conversation History: {chat_history}
-    
-    Write only the SQL query and nothing else. Do not wrap the SQL query in any other text, not even backticks. Do not respond with 'based on your SQL query'.
+    Respond with a single JSON object and nothing else, not even backticks, with two keys:
+    "sql_query": the SQL query that answers the question.
+    "answer_template": the reply to the user, with the placeholder {{rows}} where the rows returned by the query go.
+    {{rows}} becomes the bare value when the query returns a single value, such as a count, so it can sit inside a sentence; otherwise it becomes a list with one row per line, so put it on its own line after a colon.
+    Use an empty string for "answer_template" when the reply has to be written from the rows, for example a shopping list or a food recipe.
     
     For example:
     Question: which 3 artists have the most tracks?
-    SQL Query: SELECT ArtistId, COUNT(*) as track_count FROM Track GROUP BY ArtistId ORDER BY track_count DESC LIMIT 3;
+    {{"sql_query": "SELECT ArtistId, COUNT(*) as track_count FROM Track GROUP BY ArtistId ORDER BY track_count DESC LIMIT 3;", "answer_template": "These are the 3 artists with the most tracks:\\n{{rows}}"}}
     Question: Name 10 artists
-    SQL Query: SELECT Name FROM Artist LIMIT 10;
-    
-    Your turn:
-    
-    Question: {question}
-    SQL Query:
+    {{"sql_query": "SELECT Name FROM Artist LIMIT 10;", "answer_template": "Here are 10 artists:\\n{{rows}}"}}
     """
-    
-    prompt = ChatPromptTemplate.from_template(template)
-    
-    # llm = ChatOpenAI(model="gpt-4-0125-preview")
-    llm = ChatGroq(model="mixtral-8x7b-32768", temperature=0)
-    
-    def get_schema(_):
-        return db.get_table_info()
-    
-    return (
-        RunnablePassthrough.assign(schema=get_schema)
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
 
-def run_query_with_commit(db, query):
-    conn = db.engine.raw_connection()
-    cursor = conn.cursor()
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-
-def get_response(user_query: str, db: SQLDatabase, chat_history: list):
-    sql_chain = get_sql_chain(db)
-    
-    template = """
+response_system_template = """
     You are an AI data analyst who manages Home Inventory. You are interacting with a user who is asking you questions about the Home Inventory's database.
     Based on the table schema below, question, SQL query, and SQL response, write a natural language response.
     
@@ -80,105 +59,281 @@ def get_response(user_query: str, db: SQLDatabase, chat_history: list):
     Also, generate a food recipe from the food items present in HomeInventory only when asked 'generate recipe' and do not display food recipe for any other query..
     
     <SCHEMA>{schema}</SCHEMA>
-
-    Conversation History: {chat_history}
-    SQL Query: <SQL>{query}</SQL>
-    User question: {question}
-    SQL Response: {response}
     """
-    
-    prompt = ChatPromptTemplate.from_template(template)
+
+
+# Streamlit re-executes this script on every interaction, so the LLM (with its
+# cache), the prompts and the chains are held as a resource and built once per
+# process; the schema is supplied as an input on every call. No spinner: this
+# runs before st.set_page_config(), which must be the first element sent.
+@st.cache_resource(show_spinner=False)
+def load_chains() -> tuple[Runnable, Runnable]:
+    # temperature=0 makes completions deterministic, so identical prompts can be
+    # answered from the local cache instead of another round-trip to Groq.
+    set_llm_cache(SQLiteCache(database_path=".langchain.db"))
     
     # llm = ChatOpenAI(model="gpt-4-0125-preview")
     llm = ChatGroq(model="mixtral-8x7b-32768", temperature=0)
     
-    chain = (
-        RunnablePassthrough.assign(query=sql_chain).assign(
-            schema=lambda _: db.get_table_info(),
-            response=lambda vars: db.run(vars["query"]),
-        )
-        | prompt
-        | llm
-        | StrOutputParser()
+    sql_prompt = ChatPromptTemplate.from_messages([
+        ("system", sql_system_template),
+        MessagesPlaceholder("recent_history"),
+        ("human", "Question: {question}"),
+    ])
+    response_prompt = ChatPromptTemplate.from_messages([
+        ("system", response_system_template),
+        MessagesPlaceholder("recent_history"),
+        ("human", "SQL Query: <SQL>{query}</SQL>\nUser question: {question}\nSQL Response: {response}"),
+    ])
+    
+    return (
+        sql_prompt | llm | JsonOutputParser(),
+        response_prompt | llm | StrOutputParser(),
     )
+
+
+sql_query_chain, nl_response_chain = load_chains()
+
+
+# Shared across sessions and reruns, so the engine and its reflected
+# metadata are built once per set of connection settings.
+@st.cache_resource(show_spinner=False)
+def init_database(user: str, password: str, host: str, port: str, database: str) -> SQLDatabase:
+    db_uri = f"mysql+mysqldb://{user}:{password}@{host}:{port}/{database}"
+    return SQLDatabase.from_uri(
+        db_uri,
+        engine_args={"pool_size": 5, "max_overflow": 10, "pool_pre_ping": True},
+        # Skip the per-table "SELECT ... LIMIT 3" sample rows in get_table_info()
+        sample_rows_in_table_info=0,
+    )
+
+
+SCHEMA_TTL_SECONDS = 300
+
+
+# st.cache_data outlives script reruns; the leading underscore keeps Streamlit
+# from hashing the SQLDatabase, so entries are keyed on the connection URL.
+@st.cache_data(ttl=SCHEMA_TTL_SECONDS, show_spinner=False)
+def _schema_for(_db: SQLDatabase, db_url: str) -> str:
+    return _db.get_table_info()
+
+
+def get_schema(db: SQLDatabase) -> str:
+    return _schema_for(db, str(db.engine.url))
+
+
+QUERY_CACHE_TTL_SECONDS = 60
+QUERY_CACHE_MAX_ENTRIES = 128
+
+
+# Held as a resource so cached results survive Streamlit reruns
+@st.cache_resource(show_spinner=False)
+def get_query_cache() -> dict[tuple[str, int, str], tuple[float, Any]]:
+    return {}
+
+
+def _cached(key: tuple[str, int, str], compute: Callable[[], Any]) -> Any:
+    query_cache = get_query_cache()
+    now = time.monotonic()
+    cached = query_cache.get(key)
+    if cached is not None and now - cached[0] < QUERY_CACHE_TTL_SECONDS:
+        return cached[1]
+    result = compute()
+    # Re-insert so entries stay ordered oldest first, then drop expired and
+    # surplus entries from the front; the cache is shared by every session.
+    query_cache.pop(key, None)
+    query_cache[key] = (now, result)
+    while query_cache:
+        oldest_key = next(iter(query_cache))
+        oldest = query_cache.get(oldest_key)
+        if (
+            oldest is not None
+            and len(query_cache) <= QUERY_CACHE_MAX_ENTRIES
+            and now - oldest[0] < QUERY_CACHE_TTL_SECONDS
+        ):
+            break
+        query_cache.pop(oldest_key, None)
+    return result
+
+
+def cached_run(db: SQLDatabase, query: str) -> Any:
+    # Only reads are cached; a write goes through and clears the cache.
+    if not query.lstrip().upper().startswith("SELECT"):
+        result = db.run(query)
+        get_query_cache().clear()
+        return result
+    return _cached(("run", id(db), query), lambda: db.run(query))
+
+
+def fetch_rows(db: SQLDatabase, statement: TextClause) -> list[Row]:
+    def fetch():
+        with db.engine.connect() as conn:
+            return conn.execute(statement).fetchall()
     
-    return chain.invoke({
+    # Keyed apart from cached_run(), which stores db.run()'s string output
+    return _cached(("rows", id(db), statement.text), fetch)
+
+
+def get_sql_chain(db):
+    # A plain RunnableLambda runs on the calling (script) thread, where the
+    # Streamlit cache behind get_schema() has its script context.
+    return RunnableLambda(lambda inputs: {**inputs, "schema": get_schema(db)}) | sql_query_chain
+
+def run_query_with_commit(db, query):
+    with db.engine.begin() as conn:
+        conn.execute(text(query))
+    get_query_cache().clear()
+
+def format_rows(rows: list[Row]) -> str:
+    # A single value reads inline ("You have {rows} apples"); anything else is a list
+    if len(rows) == 1 and len(rows[0]) == 1:
+        return str(rows[0][0])
+    return "\n".join(f"- {', '.join(str(value) for value in row)}" for row in rows)
+
+
+def get_response(user_query: str, db: SQLDatabase, chat_history: list) -> Iterator[str]:
+    inputs = {
         "question": user_query,
-        "chat_history": chat_history,
+        # The current question is already the last message in chat_history
+        "recent_history": chat_history[:-1][-RECENT_K:],
+    }
+    # One LLM call returns both the SQL and a template for the reply
+    answer = get_sql_chain(db).invoke(inputs)
+    query = answer["sql_query"]
+    answer_template = answer.get("answer_template") or ""
+    
+    response = None
+    if "{rows}" in answer_template and query.lstrip().upper().startswith("SELECT"):
+        rows = fetch_rows(db, text(query))
+        if rows:
+            yield answer_template.replace("{rows}", format_rows(rows))
+            return
+        # Reuse the (empty) result rather than running the query again
+        response = format_rows(rows)
+    
+    # Replies that have to be written from the rows (or empty results) still
+    # get the natural language pass, streamed chunk by chunk as Groq produces it.
+    yield from nl_response_chain.stream({
+        **inputs,
+        "schema": get_schema(db),
+        "query": query,
+        "response": response if response is not None else cached_run(db, query),
     })
 
 
+# Update the table names here if necessary
+SHOW_ITEMS_SQL = text("SELECT Items, Quantity FROM inventory WHERE Quantity > 0")
+RECIPE_ITEMS_SQL = text("SELECT Items FROM Inventory WHERE Quantity > 0")
+
+# Example recipes as (ingredients, recipe name); add more recipes as needed
+RECIPES = [
+    (frozenset({"apple", "banana"}), "Fruit Salad"),
+    (frozenset({"chicken", "potato", "carrot"}), "Chicken Stew"),
+    (frozenset({"pasta", "tomato", "cheese"}), "Pasta with Tomato Sauce"),
+]
+
+
 def generate_recipe_from_inventory(db: SQLDatabase) -> str:
-    # Update the table name here if necessary
-    available_items_query = "SELECT Items FROM Inventory WHERE Quantity > 0"
-    available_items = db.run(available_items_query)
+    rows = fetch_rows(db, RECIPE_ITEMS_SQL)
     
-    if not available_items:
+    if not rows:
         return "No items available in the inventory."
     
-    # Convert the query result into a list of item names
-    available_items = [item[0] for item in available_items]
-    
-    # Define some example recipes based on the available items
-    recipes = {
-        ("apple", "banana"): "Fruit Salad",
-        ("chicken", "potato", "carrot"): "Chicken Stew",
-        ("pasta", "tomato", "cheese"): "Pasta with Tomato Sauce",
-        # Add more recipes as needed
-    }
+    available_items = {row.Items.lower() for row in rows}
     
     # Check if any of the defined recipes match the available items
-    for ingredients, recipe_name in recipes.items():
-        if all(item in available_items for item in ingredients):
-            return f"Recipe: {recipe_name}\nIngredients: {', '.join(ingredients)}"
+    for ingredients, recipe_name in RECIPES:
+        if ingredients <= available_items:
+            return f"Recipe: {recipe_name}\nIngredients: {', '.join(sorted(ingredients))}"
     
     # If no matching recipe found
     return "No recipe found with the available items."
 
 
-def handle_special_queries(user_query: str, db: SQLDatabase) -> str:
-    greetings = {
-        "hi": "Hi I am Yokie, your inventory chatbot. How can I help you?",
-        "hello": "Hi I am Yokie, your inventory chatbot. How can I help you?",
-        "hey": "Hi I am Yokie, your inventory chatbot. How can I help you?",
-        "good morning": "Good morning!",
-        "good afternoon": "Good afternoon!",
-        "good night": "Good night!"
-    }
-    farewells = ["bye", "goodbye", "see you", "later", "quit"]
-    about_bot = ["who are you", "what are you", "what do you do"]
-    thanks = ["thanks", "thank you"]
-    generic_queries = ["how are you", "what's up", "how's it going", "do you love me", "do you hate me", "i love you"]
-
-    user_query_lower = user_query.lower()
-
-    if user_query_lower in greetings:
-        return greetings[user_query_lower]
-    elif user_query_lower in farewells:
-        return "Goodbye! Have a great day!"
-    elif user_query_lower in about_bot:
-        return "I am an AI assistant here to help you manage your home inventory. Ask me anything about your inventory."
-    elif user_query_lower in thanks:
-        return "You're welcome! If you have any more questions, feel free to ask."
-    elif user_query_lower in generic_queries:
-        return "As an AI assistant, I don't have feelings, but I'm here to help you!"
-
-    # Special responses for specific queries
-    if "your name" in user_query_lower:
-        return "I am Yokie - your inventory chatbot."
-    elif "what do you do" in user_query_lower:
-        return "I am Yokie. I am here to help you with your home inventory."
-    elif "guide me" in user_query_lower:
-        return '''Click on the chatbox below and ask your query. 
-                  For example, "tell me about the items in my inventory".'''
-    elif "steps to use you" in user_query_lower:
-        return "Click on the chatbox below and ask me about your home inventory."
-    elif "who is your creator" in user_query_lower:
-        return "I have been created by the team of HomeSync."
-    elif "what can you do" in user_query_lower:
-        return '''I can update the quantity of any items in your inventory, 
+GREETING = "Hi I am Yokie, your inventory chatbot. How can I help you?"
+FAREWELL = "Goodbye! Have a great day!"
+ABOUT_BOT = "I am an AI assistant here to help you manage your home inventory. Ask me anything about your inventory."
+THANKS = "You're welcome! If you have any more questions, feel free to ask."
+NO_FEELINGS = "As an AI assistant, I don't have feelings, but I'm here to help you!"
+
+# Sentinels for the exact queries that have to read from the database.
+_GENERATE_RECIPE = object()
+_SHOW_ITEMS = object()
+
+EXACT_RESPONSES = {
+    "hi": GREETING,
+    "hello": GREETING,
+    "hey": GREETING,
+    "good morning": "Good morning!",
+    "good afternoon": "Good afternoon!",
+    "good night": "Good night!",
+    "bye": FAREWELL,
+    "goodbye": FAREWELL,
+    "see you": FAREWELL,
+    "later": FAREWELL,
+    "quit": FAREWELL,
+    "who are you": ABOUT_BOT,
+    "what are you": ABOUT_BOT,
+    "what do you do": ABOUT_BOT,
+    "thanks": THANKS,
+    "thank you": THANKS,
+    "how are you": NO_FEELINGS,
+    "what's up": NO_FEELINGS,
+    "how's it going": NO_FEELINGS,
+    "do you love me": NO_FEELINGS,
+    "do you hate me": NO_FEELINGS,
+    "i love you": NO_FEELINGS,
+    "generate recipe": _GENERATE_RECIPE,
+    "show items present": _SHOW_ITEMS,
+}
+# Interned so lookups with an interned query can match on identity
+EXACT_RESPONSES = {sys.intern(query): response for query, response in EXACT_RESPONSES.items()}
+
+# Special responses for queries containing one of these phrases
+PHRASE_RESPONSES = {
+    "your name": "I am Yokie - your inventory chatbot.",
+    "what do you do": "I am Yokie. I am here to help you with your home inventory.",
+    "guide me": '''Click on the chatbox below and ask your query. 
+                  For example, "tell me about the items in my inventory".''',
+    "steps to use you": "Click on the chatbox below and ask me about your home inventory.",
+    "who is your creator": "I have been created by the team of HomeSync.",
+    "what can you do": '''I can update the quantity of any items in your inventory, 
                   check for details of items in your inventory, 
-                  and provide you with a summarized shopping list.'''
+                  and provide you with a summarized shopping list.''',
+}
+# One alternation, so a non-matching query is rejected in a single pass. The
+# lookahead matches at every position, so phrases that overlap are all found.
+PHRASE_RE = re.compile("(?=(" + "|".join(re.escape(phrase) for phrase in PHRASE_RESPONSES) + "))")
+# When several phrases occur, the one listed first in PHRASE_RESPONSES wins
+PHRASE_PRIORITY = {phrase: priority for priority, phrase in enumerate(PHRASE_RESPONSES)}
+
+
+def show_items_present(db: SQLDatabase) -> str:
+    rows = fetch_rows(db, SHOW_ITEMS_SQL)
+    if not rows:
+        return "No items available in the inventory."
+    items_list = "\n".join(f"{row.Items}: {row.Quantity}" for row in rows)
+    return f"Items present in inventory:\n{items_list}"
+
+
+def handle_special_queries(user_query: str, db: SQLDatabase) -> str:
+    user_query_lower = sys.intern(user_query.casefold().strip())
+
+    response = EXACT_RESPONSES.get(user_query_lower)
+    if response is _GENERATE_RECIPE:
+        return generate_recipe_from_inventory(db)
+    if response is _SHOW_ITEMS:
+        return show_items_present(db)
+    if response is not None:
+        return response
+
+    match = min(
+        PHRASE_RE.finditer(user_query_lower),
+        key=lambda match: PHRASE_PRIORITY[match.group(1)],
+        default=None,
+    )
+    if match:
+        return PHRASE_RESPONSES[match.group(1)]
 
     # Handling "can you" queries
     if user_query_lower.startswith("can you"):
@@ -187,16 +342,6 @@ def handle_special_queries(user_query: str, db: SQLDatabase) -> str:
         else:
             return "No"
 
-    if user_query_lower == "generate recipe":
-        return generate_recipe_from_inventory(db)
-    elif user_query_lower == "show items present":
-        available_items_query = "SELECT Items, Quantity FROM inventory WHERE Quantity > 0"
-        available_items = db.run(available_items_query)
-        if not available_items:
-            return "No items available in the inventory."
-        items_list = "\n".join([f"{item[0]}: {item[1]}" for item in available_items])
-        return f"Items present in inventory:\n{items_list}"
-
     return None
 
 
@@ -207,6 +352,33 @@ def is_valid_query(user_query: str) -> bool:
     return True
 
 
+# Only the most recent messages get their own chat bubble; older ones are
+# folded into one markdown block that is extended as the chat grows.
+VISIBLE_MESSAGES = 10
+
+
+def render_chat_history(chat_history: list) -> None:
+    older, recent = chat_history[:-VISIBLE_MESSAGES], chat_history[-VISIBLE_MESSAGES:]
+    if older:
+        rendered_upto, transcript = st.session_state.get("earlier_transcript", (0, ""))
+        if rendered_upto < len(older):
+            transcript += "".join(
+                f"**{'AI' if isinstance(message, AIMessage) else 'Human'}:** {message.content}\n\n"
+                for message in older[rendered_upto:]
+            )
+            st.session_state.earlier_transcript = (len(older), transcript)
+        with st.expander(f"Earlier messages ({len(older)})"):
+            st.markdown(transcript)
+
+    for message in recent:
+        if isinstance(message, AIMessage):
+            with st.chat_message("AI"):
+                st.markdown(message.content)
+        elif isinstance(message, HumanMessage):
+            with st.chat_message("Human"):
+                st.markdown(message.content)
+
+
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = [
         AIMessage(content="Hello! I'm Yokie- Your AI assistant. Ask me anything about your Home inventory."),
@@ -240,13 +412,7 @@ with st.sidebar:
             st.session_state.db = db
             st.success("Connected to database!")
     
-for message in st.session_state.chat_history:
-    if isinstance(message, AIMessage):
-        with st.chat_message("AI"):
-            st.markdown(message.content)
-    elif isinstance(message, HumanMessage):
-        with st.chat_message("Human"):
-            st.markdown(message.content)
+render_chat_history(st.session_state.chat_history)
 
 user_query = st.chat_input("Type a message...")
 if user_query is not None and user_query.strip() != "":
@@ -256,36 +422,38 @@ if user_query is not None and user_query.strip() != "":
         st.markdown(user_query)
     
     special_response = handle_special_queries(user_query, st.session_state.db)
-    if special_response:
-        response = special_response
-    # elif not is_valid_query(user_query):
-    #     response = "Sorry, I could not understand, try a different query."
-    else:
-        try:
-            response = get_response(user_query, st.session_state.db, st.session_state.chat_history)
-        except Exception:
-            response = "Sorry, I could not understand, try a different query."
+    with st.chat_message("AI"):
+        if special_response:
+            response = special_response
+            st.markdown(response)
+        # elif not is_valid_query(user_query):
+        #     response = "Sorry, I could not understand, try a different query."
+        else:
+            # A failure mid-stream replaces the partial answer, so the bubble
+            # shows the same text that is stored in chat_history.
+            placeholder = st.empty()
+            try:
+                response = placeholder.write_stream(
+                    get_response(user_query, st.session_state.db, st.session_state.chat_history)
+                )
+            except Exception:
+                response = "Sorry, I could not understand, try a different query."
+                placeholder.markdown(response)
     
     st.session_state.chat_history.append(AIMessage(content=response))
-    
-    with st.chat_message("AI"):
-        st.markdown(response)
 def update_inventory(db, item_name: str, new_quantity: int) -> str:
     try:
-        cursor = db.engine.raw_connection().cursor()
-        
-        # Check if the item exists in the inventory
-        cursor.execute("SELECT * FROM Inventory WHERE Items = %s", (item_name,))
-        result = cursor.fetchone()
-        
-        if result:
-            # Update the quantity of the item
-            update_query = "UPDATE Inventory SET Quantity = %s WHERE Items = %s"
-            cursor.execute(update_query, (new_quantity, item_name))
-            db.engine.raw_connection().commit()
-            return f"Successfully updated {item_name} quantity to {new_quantity}."
-        else:
+        with db.engine.begin() as conn:
+            # rowcount is the number of matched rows, so 0 means the item doesn't exist
+            result = conn.execute(
+                text("UPDATE Inventory SET Quantity = :quantity WHERE Items = :item"),
+                {"quantity": new_quantity, "item": item_name},
+            )
+        if result.rowcount == 0:
             return f"Item '{item_name}' not found in the inventory."
+        _schema_for.clear()
+        get_query_cache().clear()
+        return f"Successfully updated {item_name} quantity to {new_quantity}."
     except Exception as e:
         return f"An error occurred: {str(e)}"
 